@@ -0,0 +1,68 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Benchmarks the ipa.py workload (reading only entry.pronunciations) with eager
+entries, field projection and lazy entries. Runs offline against a generated
+learners-shaped response.
+
+  $ python bench_ipa.py
+  eager:                 1.11 ms/lookup
+  fields=pronunciations: 0.69 ms/lookup
+  lazy_entries:          0.90 ms/lookup
+
+Most of what remains is XML parsing; senses and inflections are generators
+and were never extracted eagerly in the first place.
+
+"""
+
+import io
+import sys
+import timeit
+
+from merriam_webster.api import LearnersDictionary
+
+ENTRY = u"""
+  <entry id="word[{0}]">
+    <hw>word</hw>
+    <pr>ˈwɚd, <it>also</it> ˈwɔd</pr>
+    <altpr>ˈwəːd</altpr>
+    <sound><wav>word000{0}.wav</wav><wav>word001{0}.wav</wav></sound>
+    <art><artref id="word{0}.tif"/></art>
+    <fl>noun</fl>
+    <in><il>plural</il> <if>words</if> <il>also</il> <if>wordes</if></in>
+    <def>{1}</def>
+  </entry>"""
+
+SENSE = u"""
+      <dt>:a sound or combination of sounds that has a meaning
+        <vi>What is the <it>word</it> for this? [=what is this called?]</vi>
+        <vi>a <it>word</it> of advice</vi>
+        <un>often used in the phrase <it>in a word</it></un></dt>"""
+
+
+def make_response(entries=10, senses=8):
+    body = "".join(ENTRY.format(n, SENSE * senses) for n in range(entries))
+    xml = u'<?xml version="1.0" encoding="utf-8" ?>\n<entry_list>{0}\n' \
+          u'</entry_list>'.format(body)
+    return xml.encode('utf-8')
+
+
+def ipas(dictionary, **kwargs):
+    return set(ipa for entry in dictionary.lookup("word", **kwargs)
+               for ipa in entry.pronunciations)
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    data = make_response()
+    opener = lambda url: io.BytesIO(data)
+    eager = LearnersDictionary("KEY", opener)
+    lazy = LearnersDictionary("KEY", opener, lazy_entries=True)
+    runs = [("eager", lambda: ipas(eager)),
+            ("fields=pronunciations",
+             lambda: ipas(eager, fields=['pronunciations'])),
+            ("lazy_entries", lambda: ipas(lazy))]
+    for name, run in runs:
+        seconds = min(timeit.repeat(run, number=number, repeat=3))
+        print("{0:22} {1:.2f} ms/lookup".format(name + ":",
+                                                seconds / number * 1000))
@@ -0,0 +1,71 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Profiles the memory used by a bulk lookup run against generated responses,
+and fails (exit status 1) if more bytes are retained per entry than allowed.
+
+  $ python bench_memory.py --max-bytes-per-entry 2048
+  1000 entries, 281 bytes retained per entry
+  phase                              calls entries    allocated     retained
+  extract                             1000    1000      3559899      2173884
+  fetch                                500       0      1149061       197339
+  parse                                500       0     13187874      5216474
+  extract:LearnersDictionaryEntry     1000    1000      3559899      2173884
+  top allocation sites:
+    .../merriam_webster/standin.py:78: 129860 bytes in 100 blocks
+      return xml.encode('utf-8')
+  ...
+
+Parsed trees aren't kept unless --parsed-roots is given (the dictionaries
+keep 16 by default). --parsed-roots 64 keeps trees and their extracted
+values as well: about 1380 bytes per entry, most of it the ElementTree roots.
+
+"""
+
+import argparse
+import io
+import sys
+
+from merriam_webster.api import LearnersDictionary, CollegiateDictionary
+from merriam_webster.profiling import (AllocationProfiler,
+                                       AllocationRegressionError)
+from merriam_webster.sharedcache import ResponseCache
+from merriam_webster.standin import generate_response
+
+DICTIONARIES = {'learners': LearnersDictionary,
+                'collegiate': CollegiateDictionary}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--dictionary', choices=sorted(DICTIONARIES),
+                        default='learners')
+    parser.add_argument('--lookups', type=int, default=500)
+    parser.add_argument('--words', type=int, default=100,
+                        help="number of distinct words looked up")
+    parser.add_argument('--parsed-roots', type=int, default=0)
+    parser.add_argument('--lazy', action='store_true')
+    parser.add_argument('--frames', type=int, default=1)
+    parser.add_argument('--max-bytes-per-entry', type=float)
+    args = parser.parse_args()
+
+    def opener(url):
+        word = url.rsplit('/', 1)[1].split('?')[0]
+        return io.BytesIO(generate_response(word, args.dictionary))
+
+    profiler = AllocationProfiler(frames=args.frames)
+    dictionary = DICTIONARIES[args.dictionary](
+        "KEY", ResponseCache(urlopen=opener), lazy_entries=args.lazy,
+        parsed_roots=args.parsed_roots, profiler=profiler)
+    profiler.start()
+    for n in range(args.lookups):
+        for entry in dictionary.lookup("word{0}".format(n % args.words)):
+            list(entry.senses)
+    report = profiler.report()
+    profiler.stop()
+    print(report)
+    if args.max_bytes_per_entry is not None:
+        try:
+            report.check(args.max_bytes_per_entry)
+        except AllocationRegressionError as e:
+            print("FAILED: {0}".format(e))
+            sys.exit(1)
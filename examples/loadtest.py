@@ -0,0 +1,66 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Load-tests dictionary lookups against a local stand-in for the
+Merriam-Webster API, so no API quota is used.
+
+  $ python loadtest.py --requests 2000 --concurrency 16 --latency 0.02
+  2000 lookups (2000 ok), concurrency 16, 3.73s: 536.2 req/s, 536.2 ok/s
+  latency p50 27.8ms  p95 43.7ms  p99 50.5ms
+
+  $ python loadtest.py --dictionary collegiate --error-rate 0.05 \\
+        --malformed-rate 0.05
+  1000 lookups (893 ok), concurrency 8, 0.96s: 1041.7 req/s, 930.2 ok/s
+  latency p50 6.8ms  p95 13.2ms  p99 20.0ms
+  error latency p50 6.6ms  p95 11.9ms  p99 13.7ms
+  HTTPError: 52
+  InvalidResponseException: 55
+
+Pass --url to drive an already running server instead of starting one, and
+--data-dir to serve recorded fixtures (e.g. merriam_webster/test_data).
+
+"""
+
+import argparse
+
+from merriam_webster.api import LearnersDictionary, CollegiateDictionary
+from merriam_webster.standin import StandInServer, load_test
+
+DICTIONARIES = {'learners': LearnersDictionary,
+                'collegiate': CollegiateDictionary}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('words', nargs='*',
+                        default=['pirate', 'starfish', 'spry', 'hack'])
+    parser.add_argument('--dictionary', choices=sorted(DICTIONARIES),
+                        default='learners')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--url', help="base url of a running server")
+    parser.add_argument('--key', default='KEY')
+    parser.add_argument('--data-dir')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--malformed-rate', type=float, default=0)
+    parser.add_argument('--invalid-key', action='store_true')
+    args = parser.parse_args()
+
+    dictionary = DICTIONARIES[args.dictionary](args.key)
+    server = None
+    if args.url:
+        dictionary.base_url = args.url
+    else:
+        server = StandInServer(data_dir=args.data_dir, latency=args.latency,
+                               jitter=args.jitter, error_rate=args.error_rate,
+                               malformed_rate=args.malformed_rate,
+                               invalid_key=args.invalid_key).start()
+        dictionary.base_url = server.base_url(args.dictionary)
+    try:
+        print(load_test(dictionary, args.words, args.requests,
+                        args.concurrency))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
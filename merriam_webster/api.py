@@ -1,8 +1,14 @@
 # -*- encoding: utf-8 -*-
 
 import re
+import threading
+import unicodedata
+import weakref
 import xml.etree.cElementTree as ElementTree
 
+from collections import OrderedDict
+from contextlib import nullcontext
+from types import GeneratorType
 from abc import ABCMeta, abstractmethod, abstractproperty
 from urllib.parse import quote, quote_plus
 from urllib.request import urlopen
@@ -25,20 +31,153 @@ class InvalidResponseException(WordNotFoundException):
         message = "{0} not found. (Malformed XML from server).".format(word)
         KeyError.__init__(self, message, *args, **kwargs)
 
+class InvalidQueryException(WordNotFoundException):
+    def __init__(self, word, *args, **kwargs):
+        self.word = word
+        self.suggestions = []
+        message = "{0!r} not found. (Query can never match).".format(word)
+        KeyError.__init__(self, message, *args, **kwargs)
+
 class InvalidAPIKeyException(Exception):
     pass
 
+class QueryCanonicalizer(object):
+    """ Callable mapping a query to its canonical form: Unicode NFC, case
+    folded, trimmed, whitespace runs collapsed to single spaces, headword
+    markers (*), entry id suffixes ([1]) and format characters (soft
+    hyphens, zero-width joiners and other Cf characters) removed. Passed as the
+    canonicalizer of an MWApiWrapper, it makes "Pirate", " pirate " and
+    "pirate\u00a0" one request and one cache key.
+
+    Queries that are empty once canonicalized, contain control characters or
+    surrogates, or have no letters or digits raise InvalidQueryException.
+
+    stats() counts queries, those whose canonical form differs from what was
+    asked for, rejections, and deduplicated queries: spellings not seen
+    before whose canonical form had already been requested, i.e. requests
+    and cache keys that canonicalization saved. Only the capacity most
+    recently used spellings and canonical forms are remembered for this, so
+    memory stays bounded in long runs; 'distinct' counts the remembered
+    canonical forms.
+
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self.reset()
+
+    def canonicalize(self, query):
+        " Returns the canonical form of query, without recording stats. "
+        word = unicodedata.normalize('NFC', query)
+        word = re.sub(r'\[\d+\]\s*$', '', word)
+        # before collapsing, so "ice * cream" doesn't keep two spaces
+        word = ''.join(c for c in word.replace('*', '')
+                       if unicodedata.category(c) != 'Cf')
+        word = re.sub(r'\s+', ' ', word).strip()
+        word = unicodedata.normalize('NFC', word.casefold())
+        if not word or \
+           any(unicodedata.category(c) in ('Cc', 'Cs') for c in word) or \
+           not any(c.isalnum() for c in word):
+            raise InvalidQueryException(query)
+        return word
+
+    def __call__(self, word):
+        try:
+            canonical = self.canonicalize(word)
+        except InvalidQueryException:
+            with self._lock:
+                self._stats['queries'] += 1
+                self._stats['rejected'] += 1
+            raise
+        with self._lock:
+            self._stats['queries'] += 1
+            if canonical != word:
+                self._stats['canonicalized'] += 1
+            seen = self._remember(self._seen, word)
+            if self._remember(self._canonical, canonical) and not seen:
+                self._stats['deduplicated'] += 1
+        return canonical
+
+    def _remember(self, lru, key):
+        " Adds key to the LRU lru; returns whether it was already there. "
+        present = key in lru
+        if present:
+            lru.move_to_end(key)
+        else:
+            lru[key] = None
+            while len(lru) > self.capacity:
+                lru.popitem(last=False)
+        return present
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['distinct'] = len(self._canonical)
+        return stats
+
+    def reset(self):
+        " Forgets the queries seen and zeroes the counters. "
+        with self._lock:
+            self._seen = OrderedDict()
+            self._canonical = OrderedDict()
+            self._stats = {'queries': 0, 'canonicalized': 0, 'rejected': 0,
+                           'deduplicated': 0}
+
 class MWApiWrapper:
-    """ Defines an interface for wrappers to Merriam Webster web APIs. """
+    """ Defines an interface for wrappers to Merriam Webster web APIs.
+
+    Subclasses set base_url and implement parse_xml(root, word), returning
+    the entries of a parsed response. Those building their entries with
+    _build_entry, as the dictionaries here do, must also define entry_class
+    (the MWDictionaryEntry subclass to build) and take parse_xml's optional
+    fields argument. lookup() only passes fields when it's given, and needs
+    entry_class to check them, so parse_xml(root, word) subclasses keep
+    working without either as long as fields isn't used.
+
+    """
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, key=None, urlopen=urlopen):
+    def __init__(self, key=None, urlopen=urlopen, lazy_entries=False,
+                 parsed_roots=16, index=None, profiler=None,
+                 canonicalizer=None):
         """ key is the API key string to use for requests. urlopen is a function
         that accepts a url string and returns a file-like object of the results
-        of fetching the url. defaults to urllib2.urlopen, and should throw """
+        of fetching the url. defaults to urllib2.urlopen, and should throw
+
+        If lazy_entries is true, entries keep a reference to their <entry>
+        element and each attribute is only extracted on first access.
+
+        If urlopen's responses have a content_hash attribute (as those from
+        sharedcache do), the parsed trees of up to parsed_roots responses are
+        kept by hash, along with the values extracted from each of their
+        entries. Unchanged responses then skip both parsing and extraction;
+        only the entry objects are built anew. Extracted senses and
+        inflections are kept as lists and handed out as iterators. Set
+        parsed_roots to 0 to keep nothing.
+
+        index is an optional index.DefinitionIndex that every parsed entry is
+        added to. Indexing reads each entry's senses (into a list), so lazy
+        entries won't defer them.
+
+        profiler is an optional profiling.AllocationProfiler that records the
+        allocations of each lookup phase.
+
+        canonicalizer is an optional QueryCanonicalizer applied to every
+        looked up word before it's requested.
+
+        """
         self.key = key
         self.urlopen = urlopen
+        self.lazy_entries = lazy_entries
+        self.parsed_roots = parsed_roots
+        self._roots = OrderedDict()
+        self._roots_lock = threading.Lock()
+        self._extracted = weakref.WeakKeyDictionary()  # <entry> -> {arg: ..}
+        self.index = index
+        self.profiler = profiler
+        self.canonicalizer = canonicalizer
 
     @abstractproperty
     def base_url():
@@ -47,8 +186,13 @@ class MWApiWrapper:
         """
         pass
 
+    @abstractproperty
+    def entry_class():
+        """ The MWDictionaryEntry subclass built from each <entry> element. """
+        pass
+
     @abstractmethod
-    def parse_xml(root, word):
+    def parse_xml(root, word, fields=None):
         pass
 
     def request_url(self, word):
@@ -68,26 +212,150 @@ class MWApiWrapper:
         qstring = "{0}?key={1}".format(quote(word), quote_plus(self.key))
         return ("{0}/xml/{1}").format(self.base_url, qstring)
 
-    def lookup(self, word):
-        response = self.urlopen(self.request_url(word))
-        data = response.read().decode('utf-8')
+    def lookup(self, word, fields=None):
+        """ Returns a generator of entries for word.
+
+        fields is an optional iterable of entry attribute names (see
+        MWDictionaryEntry.fields). Only those attributes are extracted from
+        the response, the rest are left as None.
+
+        """
+        if fields is not None:
+            fields = tuple(fields)
+            unknown = set(fields) - set(self.entry_class.fields)
+            if unknown:
+                raise ValueError("Unknown entry fields: {0}".format(
+                    ", ".join(sorted(unknown))))
+        if self.canonicalizer is not None:
+            word = self.canonicalizer(word)
+        with self._phase('fetch'):
+            response = self.urlopen(self.request_url(word))
+            content_hash = getattr(response, 'content_hash', None)
+            root = self._cached_root(content_hash)
+            if root is None:
+                data = response.read()
+        if root is None:
+            with self._phase('parse'):
+                root = self._parse_response(data, word)
+            self._cache_root(content_hash, root)
+
+        suggestions = root.findall("suggestion")
+        if suggestions:
+            suggestions = [s.text for s in suggestions]
+            raise WordNotFoundException(word, suggestions)
+
+        if fields is None:
+            return self.parse_xml(root, word)
+        return self.parse_xml(root, word, fields)
+
+    def _cached_root(self, content_hash):
+        " Returns the tree parsed from the response with content_hash. "
+        if content_hash is None or not self.parsed_roots:
+            return None
+        with self._roots_lock:
+            root = self._roots.get(content_hash)
+            if root is not None:
+                self._roots.move_to_end(content_hash)
+            return root
+
+    def _cache_root(self, content_hash, root):
+        if content_hash is None or not self.parsed_roots:
+            return
+        with self._roots_lock:
+            self._roots[content_hash] = root
+            while len(self._roots) > self.parsed_roots:
+                self._roots.popitem(last=False)
+
+    def _parse_response(self, data, word):
+        " Returns the root element of the response bytes data. "
+        data = data.decode('utf-8')
         try:
-            root = ElementTree.fromstring(data)
+            return ElementTree.fromstring(data)
         except ElementTree.ParseError:
             if re.search("Invalid API key", data):
                 raise InvalidAPIKeyException()
             data = re.sub(r'&(?!amp;)', '&amp;', data)
             try:
-                root = ElementTree.fromstring(data)
+                return ElementTree.fromstring(data)
             except ElementTree.ParseError:
                 raise InvalidResponseException(word)
 
-        suggestions = root.findall("suggestion")
-        if suggestions:
-            suggestions = [s.text for s in suggestions]
-            raise WordNotFoundException(word, suggestions)
+    def _build_entry(self, word, entry, fields=None, num=0):
+        """ Returns an entry_class instance for the <entry> element entry,
+        the num'th of the response.
 
-        return self.parse_xml(root, word)
+        """
+        if fields is None:
+            fields = tuple(self.entry_class.fields)
+        with self._phase('extract', self.entry_class.__name__, entries=1):
+            if self.lazy_entries:
+                result = self.entry_class.lazy(word, entry, self, fields)
+            else:
+                args = {}
+                for name in fields:
+                    arg = self.entry_class.fields[name]
+                    args[arg] = self._extract(entry, arg)
+                result = self.entry_class(word, args)
+            if self.index is not None and result.senses is not None:
+                # extract what the index reads here, not under index
+                result.senses = list(result.senses)
+                for name in ('headword', 'function'):
+                    getattr(result, name)
+        if self.index is not None and result.senses is not None:
+            with self._phase('index'):
+                entry_id = entry.get('id') or "{0}[{1}]".format(word, num + 1)
+                self.index.add(result, entry_id)
+        return result
+
+    def _phase(self, name, entry_class=None, entries=0):
+        " Returns a context manager recording allocations as phase name. "
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name, entry_class, entries)
+
+    def _extract(self, entry, arg):
+        """ Returns the parse_xml argument arg extracted from entry, reusing
+        the value extracted before if entry belongs to a kept tree. When
+        profiling, generators (senses, inflections) are run into lists here
+        so their cost is recorded in the current phase.
+
+        """
+        extracted = self._extracted_args(entry)
+        if extracted is not None and arg in extracted:
+            value, generated = extracted[arg]
+        else:
+            value = getattr(self, '_get_' + arg)(entry)
+            generated = isinstance(value, GeneratorType)
+            if generated and (extracted is not None or
+                              self.profiler is not None):
+                value = list(value)
+            if extracted is not None:
+                extracted[arg] = (value, generated)
+        if extracted is None:
+            return value
+        # kept values are shared by every lookup, so hand out copies
+        if generated and self.profiler is None:
+            return iter(value)
+        return list(value) if isinstance(value, list) else value
+
+    def _extracted_args(self, entry):
+        " Returns the dict of values extracted from entry, if it's kept. "
+        if not self.parsed_roots:
+            return None
+        with self._roots_lock:
+            return self._extracted.setdefault(entry, {})
+
+    def _get_headword(self, root):
+        return root.find("hw").text
+
+    def _get_functional_label(self, root):
+        return getattr(root.find('fl'), 'text', None)
+
+    def _get_sound_fragments(self, root):
+        sound = root.find("sound")
+        if sound:
+            return [s.text for s in sound]
+        return []
 
     def _flatten_tree(self, root, exclude=None):
         """ Returns a list containing the (non-None) .text and .tail for all
@@ -116,25 +384,20 @@ class LearnersDictionary(MWApiWrapper):
 
     base_url = "http://www.dictionaryapi.com/api/v1/references/learners"
 
-    def parse_xml(self, root, word):
+    @property
+    def entry_class(self):
+        return LearnersDictionaryEntry
+
+    def parse_xml(self, root, word, fields=None):
         entries = root.findall("entry")
         for num, entry in enumerate(entries):
-            args = {}
-            args['illustration_fragments'] = [e.get('id') for e in
-                                     entry.findall("art/artref")
-                                     if e.get('id')]
-            args['headword'] = entry.find("hw").text
-            args['pronunciations'] = self._get_pronunciations(entry)
-            sound = entry.find("sound")
-            args['sound_fragments'] = []
-            if sound:
-                args['sound_fragments'] = [s.text for s in sound]
-            args['functional_label'] = getattr(entry.find('fl'), 'text', None)
-            args['inflections'] = self._get_inflections(entry)
-            args['senses'] = self._get_senses(entry)
-            yield LearnersDictionaryEntry(
+            yield self._build_entry(
                 re.sub(r'(?:\[\d+\])?\s*', '', entry.get('id')),
-                       args)
+                entry, fields, num)
+
+    def _get_illustration_fragments(self, root):
+        return [e.get('id') for e in root.findall("art/artref")
+                if e.get('id')]
 
     def _get_inflections(self, root):
         """ Returns a generator of Inflections found in root.
@@ -219,7 +482,84 @@ class WordSense(object):
         yield self.definition
         yield self.examples
 
+class _LazyAttribute(object):
+    """ Non-data descriptor for lazily materialized entry attributes.
+
+    Eagerly built entries set the attribute on the instance, which shadows
+    the descriptor. Lazy entries fall through to it on first access; the
+    extracted value is then cached in the instance __dict__.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance._materialize(self.name)
+        instance.__dict__[self.name] = value
+        return value
+
+
 class MWDictionaryEntry(object):
+
+    # maps entry attribute names to the parse_xml argument they're built from
+    fields = {'headword': 'headword',
+              'function': 'functional_label',
+              'pronunciations': 'pronunciations',
+              'inflections': 'inflections',
+              'senses': 'senses',
+              'audio': 'sound_fragments',
+              'illustrations': 'illustration_fragments'}
+
+    headword = _LazyAttribute('headword')
+    function = _LazyAttribute('function')
+    pronunciations = _LazyAttribute('pronunciations')
+    inflections = _LazyAttribute('inflections')
+    senses = _LazyAttribute('senses')
+    audio = _LazyAttribute('audio')
+    illustrations = _LazyAttribute('illustrations')
+
+    _element = None
+
+    def __init__(self, word, attrs):
+        self.word = word
+        for name, arg in self.fields.items():
+            setattr(self, name, self._build_attribute(name, attrs.get(arg)))
+
+    @classmethod
+    def lazy(cls, word, element, dictionary, fields=None):
+        """ Returns an entry whose attributes are extracted from the <entry>
+        element on first access, using dictionary's extraction methods.
+        Attributes not in fields are None.
+
+        """
+        entry = cls.__new__(cls)
+        entry.word = word
+        entry._element = element
+        entry._dictionary = dictionary
+        entry._fields = frozenset(cls.fields if fields is None else fields)
+        return entry
+
+    def _materialize(self, name):
+        if self._element is None or name not in self._fields:
+            return None
+        with self._dictionary._phase('extract', self.__class__.__name__):
+            value = self._dictionary._extract(self._element,
+                                              self.fields[name])
+            return self._build_attribute(name, value)
+
+    def _build_attribute(self, name, value):
+        " Converts a parse_xml argument into the entry attribute name. "
+        if value is None:
+            return None
+        if name == 'audio':
+            return [self.build_sound_url(f) for f in value]
+        if name == 'illustrations':
+            return [self.build_illustration_url(f) for f in value]
+        return value
+
     def build_sound_url(self, fragment):
         base_url = "http://media.merriam-webster.com/soundc11"
         prefix_match = re.search(r'^([0-9]+|gg|bix)', fragment)
@@ -231,20 +571,15 @@ class MWDictionaryEntry(object):
 
 
 class LearnersDictionaryEntry(MWDictionaryEntry):
+
+    alternate_headwords = None
+
     def __init__(self, word, attrs):
         # word,  pronounce, sound_url, art_url, inflection, pos
-
-        self.word = word
-        self.headword = attrs.get("headword")
+        # inflections: (form, [pr], note,)
+        # senses: list of ("def text", ["examples"]
+        MWDictionaryEntry.__init__(self, word, attrs)
         self.alternate_headwords = attrs.get("alternate_headwords")
-        self.pronunciations = attrs.get("pronunciations")
-        self.function = attrs.get("functional_label")
-        self.inflections = attrs.get("inflections") # (form, [pr], note,)
-        self.senses = attrs.get("senses")  # list of ("def text", ["examples"]
-        self.audio = [self.build_sound_url(f) for f in
-                      attrs.get("sound_fragments")]
-        self.illustrations = [self.build_illustration_url(f) for f in
-                              attrs.get("illustration_fragments")]
 
     def build_illustration_url(self, fragment):
         base_url = "www.learnersdictionary.com/art/ld"
@@ -252,18 +587,6 @@ class LearnersDictionaryEntry(MWDictionaryEntry):
         return "{0}/{1}".format(base_url, fragment)
 
 class CollegiateDictionaryEntry(MWDictionaryEntry):
-    def __init__(self, word, attrs):
-        self.word = word
-        self.headword = attrs.get('headword')
-        self.function = attrs.get('functional_label')
-        self.pronunciations = attrs.get("pronunciations")
-        self.inflections = attrs.get("inflections")
-        self.senses = attrs.get("senses")
-        self.audio = [self.build_sound_url(f) for f in
-                      attrs.get("sound_fragments")]
-        self.illustrations = [self.build_illustration_url(f) for f in
-                              attrs.get("illustration_fragments")]
-
 
     def build_illustration_url(self, fragment):
         base_url = 'http://www.merriam-webster.com/art/dict'
@@ -291,22 +614,16 @@ class CollegiateDictionaryEntry(MWDictionaryEntry):
 class CollegiateDictionary(MWApiWrapper):
     base_url = "http://www.dictionaryapi.com/api/v1/references/collegiate"
 
-    def parse_xml(self, root, word):
-        for entry in root.findall('entry'):
-            args = {}
-            args['headword'] = entry.find('hw').text
-            args['functional_label'] = getattr(entry.find('fl'), 'text', None)
-            args['pronunciations'] = self._get_pronunciations(entry)
-            args['inflections'] = self._get_inflections(entry)
-            args['senses'] = self._get_senses(entry)
-            args['sound_fragments'] = []
-            args['illustration_fragments'] = [e.text for e in
-                                              entry.findall("art/bmp")
-                                              if e.text]
-            sound = entry.find("sound")
-            if sound:
-                args['sound_fragments'] = [s.text for s in sound]
-            yield CollegiateDictionaryEntry(word, args)
+    @property
+    def entry_class(self):
+        return CollegiateDictionaryEntry
+
+    def parse_xml(self, root, word, fields=None):
+        for num, entry in enumerate(root.findall('entry')):
+            yield self._build_entry(word, entry, fields, num)
+
+    def _get_illustration_fragments(self, root):
+        return [e.text for e in root.findall("art/bmp") if e.text]
 
     def _get_pronunciations(self, root):
         """ Returns list of IPA for regular and 'alternative' pronunciation. """
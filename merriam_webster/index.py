@@ -0,0 +1,244 @@
+# -*- encoding: utf-8 -*-
+
+"""
+An inverted full-text index over parsed dictionary entries, for reverse
+dictionary queries ("words whose definition mentions X").
+
+Each WordSense is a document. Its definition, usage examples and the entry's
+functional label are tokenized into positional postings, so both ranked term
+queries and quoted phrase queries are supported:
+
+  >>> index = DefinitionIndex()
+  >>> learners = LearnersDictionary(key, index=index)
+  >>> list(learners.lookup("pirate"))
+  >>> index.search('"at sea" steals')
+  [Hit('pirate', 'pi*rate', 'noun', 'someone who attacks and steals')]
+
+Entries are added as they're parsed, keyed by their MW entry id (e.g.
+bank[2]), so homographs are kept apart and looking an entry up under other
+spellings doesn't index it twice; adding an entry again replaces its senses.
+A DefinitionIndex can be shared by threads. save() and load() use a
+zlib-compressed JSON file with delta-encoded postings.
+
+"""
+
+import json
+import math
+import re
+import threading
+import zlib
+
+from collections import defaultdict
+
+# positions skipped between a sense's definition, examples and functional
+# label, so that phrases can't match across them.
+_SEGMENT_GAP = 100
+
+FORMAT_VERSION = 3
+
+
+def tokenize(text):
+    " Returns the lowercased word tokens of text. "
+    return re.findall(r"[^\W_]+", text.lower()) if text else []
+
+
+class Hit(object):
+    """ A sense matching a query. """
+
+    def __init__(self, word, headword, function, definition, score=0.0):
+        self.word = word
+        self.headword = headword
+        self.function = function
+        self.definition = definition
+        self.score = score
+
+    def __repr__(self):
+        return "Hit({0!r}, {1!r}, {2!r}, {3!r})".format(
+            self.word, self.headword, self.function, self.definition[:30])
+
+
+class DefinitionIndex(object):
+    """ Positional inverted index of sense definitions, usage examples and
+    functional labels.
+
+    Documents are identified by integer ids; _docs holds each document's
+    (word, headword, function, definition, length in tokens) or None once
+    removed, _doc_terms its set of terms, and _postings maps
+    term -> {doc id: [positions]}. _lock guards all of them.
+
+    """
+
+    def __init__(self):
+        self._docs = []
+        self._doc_terms = []
+        self._postings = defaultdict(dict)
+        self._entries = {}  # entry id -> [doc ids]
+        self._live = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        " Returns the number of indexed senses. "
+        return self._live
+
+    def add(self, entry, entry_id):
+        """ Indexes the senses of entry, replacing any previously indexed
+        senses with the same entry_id. MWApiWrapper passes the <entry> id
+        attribute, like "bank[2]", or the word and the entry's position in
+        the response (e.g. "bank[2]" again) if there's none. entry.senses
+        must be re-iterable (a list, not a generator).
+
+        """
+        doc = (entry.word, entry.headword, entry.function)
+        with self._lock:
+            self._remove(entry_id)
+            doc_ids = self._entries[entry_id] = []
+            for definition, examples in entry.senses or []:
+                segments = [definition] + list(examples) + [entry.function]
+                doc_ids.append(self._add_document(doc, definition, segments))
+
+    def remove(self, entry_id):
+        " Removes the senses indexed for an entry, if any. "
+        with self._lock:
+            self._remove(entry_id)
+
+    def _remove(self, entry_id):
+        for doc_id in self._entries.pop(entry_id, []):
+            for term in self._doc_terms[doc_id]:
+                postings = self._postings[term]
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+            self._docs[doc_id] = self._doc_terms[doc_id] = None
+            self._live -= 1
+
+    def _add_document(self, doc, definition, segments):
+        doc_id = len(self._docs)
+        position, length, terms = 0, 0, set()
+        for segment in segments:
+            for token in tokenize(segment):
+                self._postings[token].setdefault(doc_id, []).append(position)
+                terms.add(token)
+                position += 1
+                length += 1
+            position += _SEGMENT_GAP
+        self._docs.append(doc + (definition, length))
+        self._doc_terms.append(terms)
+        self._live += 1
+        return doc_id
+
+    def search(self, query, limit=10):
+        """ Returns up to limit Hits for senses containing every term and
+        "quoted phrase" in query, best first. Scores are tf-idf, normalized
+        by document length.
+
+        """
+        phrases = [tokenize(p) for p in re.findall(r'"([^"]*)"', query)]
+        terms = tokenize(re.sub(r'"[^"]*"', ' ', query))
+        phrases = [p for p in phrases if p]
+        required = set(terms).union(*phrases)
+        if not required:
+            return []
+        hits = []
+        with self._lock:
+            postings = [self._postings.get(t, {}) for t in required]
+            candidates = set(min(postings, key=len))
+            for p in postings:
+                candidates.intersection_update(p)
+            for doc_id in candidates:
+                if all(self._has_phrase(doc_id, p) for p in phrases):
+                    hits.append(self._hit(doc_id, required))
+        hits.sort(key=lambda hit: -hit.score)
+        return hits[:limit]
+
+    def _has_phrase(self, doc_id, phrase):
+        starts = set(self._postings[phrase[0]][doc_id])
+        for offset, term in enumerate(phrase[1:], 1):
+            positions = self._postings[term][doc_id]
+            starts.intersection_update(p - offset for p in positions)
+            if not starts:
+                return False
+        return True
+
+    def _hit(self, doc_id, terms):
+        word, headword, function, definition, length = self._docs[doc_id]
+        score = 0.0
+        for term in terms:
+            postings = self._postings[term]
+            idf = math.log(1.0 + float(self._live) / len(postings))
+            score += len(postings[doc_id]) * idf
+        return Hit(word, headword, function, definition,
+                   score / math.sqrt(length))
+
+    def save(self, filename):
+        """ Writes the index to filename. Removed documents are dropped and
+        the remaining ids renumbered.
+
+        """
+        with self._lock:
+            data = self._dump()
+        with open(filename, 'wb') as fh:
+            fh.write(zlib.compress(data.encode('utf-8')))
+
+    def _dump(self):
+        " Returns the index as a JSON string. "
+        renumber, docs = {}, []
+        for doc_id, doc in enumerate(self._docs):
+            if doc is not None:
+                renumber[doc_id] = len(docs)
+                docs.append(doc)
+        postings = {}
+        for term, term_postings in self._postings.items():
+            encoded, previous = [], 0
+            for doc_id in sorted(term_postings, key=renumber.get):
+                new_id = renumber[doc_id]
+                positions = term_postings[doc_id]
+                encoded.extend([new_id - previous, len(positions)])
+                encoded.extend(_deltas(positions))
+                previous = new_id
+            postings[term] = encoded
+        entries = [[entry_id, [renumber[d] for d in doc_ids]]
+                   for entry_id, doc_ids in self._entries.items()]
+        return json.dumps({'version': FORMAT_VERSION, 'docs': docs,
+                           'entries': entries, 'postings': postings},
+                          separators=(',', ':'))
+
+    @classmethod
+    def load(cls, filename):
+        " Returns the DefinitionIndex saved to filename. "
+        with open(filename, 'rb') as fh:
+            data = json.loads(zlib.decompress(fh.read()).decode('utf-8'))
+        if data.get('version') != FORMAT_VERSION:
+            raise ValueError("Unsupported index format: {0!r}".format(
+                data.get('version')))
+        index = cls()
+        index._docs = [tuple(doc) for doc in data['docs']]
+        index._doc_terms = [set() for doc in index._docs]
+        index._live = len(index._docs)
+        for entry_id, doc_ids in data['entries']:
+            index._entries[entry_id] = doc_ids
+        for term, encoded in data['postings'].items():
+            term_postings, doc_id, i = {}, 0, 0
+            while i < len(encoded):
+                doc_id += encoded[i]
+                count = encoded[i + 1]
+                term_postings[doc_id] = _undeltas(encoded[i + 2:i + 2 + count])
+                index._doc_terms[doc_id].add(term)
+                i += 2 + count
+            index._postings[term] = term_postings
+        return index
+
+
+def _deltas(values):
+    previous, deltas = 0, []
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+def _undeltas(deltas):
+    total, values = 0, []
+    for delta in deltas:
+        total += delta
+        values.append(total)
+    return values
@@ -0,0 +1,224 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Opt-in allocation profiling of dictionary lookups, built on tracemalloc.
+
+Pass an AllocationProfiler as the profiler argument of an MWApiWrapper and
+each lookup is split into phases: fetch (urlopen and read), parse (building
+the ElementTree), extract (building each entry, also tallied per entry
+class) and index (adding entries to a DefinitionIndex). For every phase the
+bytes allocated (peak above the starting point) and still retained when it
+ends are recorded. Reports also give how much the heap grew over the whole
+run per entry built, which is what long bulk runs care about.
+
+  >>> profiler = AllocationProfiler()
+  >>> learners = LearnersDictionary(key, profiler=profiler)
+  >>> for word in words:
+  ...     list(learners.lookup(word))
+  >>> report = profiler.report()
+  >>> print(report)
+  >>> report.check(max_bytes_per_entry=4096)
+
+While profiling, entries' senses and inflections are built as lists inside
+the extract phase rather than as generators run later by the caller, and
+the attributes of lazy entries are recorded under extract and their entry
+class when first read. The top allocation sites compare the heap at start()
+with the heap at report().
+
+tracemalloc's counters are process-wide, so phases can't be measured while
+lookups run concurrently: a phase entered from a second thread while another
+is active raises RuntimeError. Phases entered inside another phase on the
+same thread are counted as part of the outer one: only the entries they
+build are added to their own totals.
+
+"""
+
+import linecache
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+from os import path
+
+
+class AllocationRegressionError(Exception):
+    pass
+
+
+class PhaseStats(object):
+    """ Allocation totals for a phase or entry class, in bytes. """
+
+    def __init__(self):
+        self.calls = 0
+        self.entries = 0
+        self.allocated = 0
+        self.retained = 0
+
+    def __repr__(self):
+        return ("PhaseStats(calls={0}, entries={1}, allocated={2}, "
+                "retained={3})").format(self.calls, self.entries,
+                                        self.allocated, self.retained)
+
+
+class AllocationReport(object):
+    """ Per-phase and per-entry-class allocation totals, the heap growth in
+    bytes and the top allocation sites (as (filename, lineno, bytes, blocks)
+    tuples) of a run.
+
+    """
+
+    def __init__(self, phases, entry_classes, growth, top_sites):
+        self.phases = phases
+        self.entry_classes = entry_classes
+        self.growth = growth
+        self.top_sites = top_sites
+
+    @property
+    def entries(self):
+        return sum(stats.entries for stats in self.entry_classes.values())
+
+    @property
+    def bytes_per_entry(self):
+        " Bytes the heap grew by over the run, per entry built. "
+        if not self.entries:
+            return 0.0
+        return float(self.growth) / self.entries
+
+    def check(self, max_bytes_per_entry):
+        """ Raises AllocationRegressionError if bytes_per_entry exceeds
+        max_bytes_per_entry.
+
+        """
+        if self.bytes_per_entry > max_bytes_per_entry:
+            raise AllocationRegressionError(
+                "{0:.0f} bytes retained per entry, more than the allowed "
+                "{1}".format(self.bytes_per_entry, max_bytes_per_entry))
+
+    def __str__(self):
+        lines = ["{0} entries, {1:.0f} bytes retained per entry".format(
+            self.entries, self.bytes_per_entry)]
+        lines.append("{0:32} {1:>7} {2:>7} {3:>12} {4:>12}".format(
+            "phase", "calls", "entries", "allocated", "retained"))
+        rows = sorted(self.phases.items()) + \
+               [("extract:" + name, stats)
+                for name, stats in sorted(self.entry_classes.items())]
+        for name, stats in rows:
+            lines.append("{0:32} {1:7} {2:7} {3:12} {4:12}".format(
+                name, stats.calls, stats.entries, stats.allocated,
+                stats.retained))
+        if self.top_sites:
+            lines.append("top allocation sites:")
+        for filename, lineno, size, count in self.top_sites:
+            lines.append("  {0}:{1}: {2} bytes in {3} blocks".format(
+                filename, lineno, size, count))
+            source = linecache.getline(filename, lineno).strip()
+            if source:
+                lines.append("    " + source)
+        return "\n".join(lines)
+
+
+class AllocationProfiler(object):
+    """ Records allocations per lookup phase with tracemalloc.
+
+    Tracing starts at the first phase (or at start()) with frames frames of
+    traceback per allocation. top is the number of allocation sites kept in
+    reports.
+
+    """
+
+    def __init__(self, frames=1, top=10):
+        self.frames = frames
+        self.top = top
+        self._phases = {}
+        self._entry_classes = {}
+        self._started_tracing = False
+        self._baseline = None
+        self._lock = threading.Lock()
+        self._active = None  # thread running the outermost phase
+        self._depth = 0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        if self._baseline is None:
+            self._baseline = self._snapshot()
+
+    def stop(self):
+        " Stops tracing, if this profiler started it. "
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self._baseline = None
+
+    @contextmanager
+    def phase(self, name, entry_class=None, entries=0):
+        """ Records the allocations made in the with block as phase name. If
+        entry_class is given they're also tallied under that (class) name,
+        along with entries entries built.
+
+        """
+        if self._baseline is None:
+            self.start()
+        thread = threading.current_thread()
+        with self._lock:
+            if self._active is not None and self._active is not thread:
+                raise RuntimeError(
+                    "AllocationProfiler can't measure concurrent lookups: "
+                    "tracemalloc's counters are process-wide")
+            self._active = thread
+            self._depth += 1
+            outermost = self._depth == 1
+        if outermost:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            if outermost:
+                current, peak = tracemalloc.get_traced_memory()
+            targets = []
+            if outermost or entries:
+                targets.append(self._phases.setdefault(name, PhaseStats()))
+                if entry_class is not None:
+                    targets.append(self._entry_classes.setdefault(
+                        entry_class, PhaseStats()))
+            for stats in targets:
+                stats.entries += entries
+                if outermost:
+                    stats.calls += 1
+                    stats.allocated += peak - before
+                    stats.retained += current - before
+            with self._lock:
+                self._depth -= 1
+                if not self._depth:
+                    self._active = None
+
+    def report(self):
+        " Returns an AllocationReport of everything recorded so far. "
+        growth, top_sites = 0, []
+        if self._baseline is not None:
+            diffs = self._snapshot().compare_to(self._baseline, 'lineno')
+            growth = sum(diff.size_diff for diff in diffs)
+            diffs = [diff for diff in diffs if diff.size_diff > 0]
+            diffs.sort(key=lambda diff: -diff.size_diff)
+            for diff in diffs[:self.top]:
+                frame = diff.traceback[0]
+                top_sites.append((frame.filename, frame.lineno,
+                                  diff.size_diff, diff.count_diff))
+        return AllocationReport(dict(self._phases), dict(self._entry_classes),
+                                growth, top_sites)
+
+    def reset(self):
+        " Forgets recorded phases and rebases the allocation sites. "
+        self._phases.clear()
+        self._entry_classes.clear()
+        if self._baseline is not None:
+            self._baseline = self._snapshot()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+            tracemalloc.Filter(False, path.splitext(__file__)[0] + '.py*'),
+        ])
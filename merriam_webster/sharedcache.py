@@ -0,0 +1,364 @@
+# -*- encoding: utf-8 -*-
+
+"""
+A response cache shared by every worker process on a host.
+
+One CacheServer listens on a Unix domain socket and keeps an LRU of raw API
+responses keyed by request url. Workers pass a CacheClient as the urlopen
+argument of their MWApiWrapper, so a word is fetched from Merriam-Webster at
+most once per host while it stays cached. Concurrent misses for the same url
+are coalesced into a single upstream request.
+
+With a ttl, expired responses are revalidated with conditional GETs using
+their ETag/Last-Modified validators. Within the grace window after expiry
+the stale response is served immediately while revalidation runs in the
+background. Every response carries a content hash, which MWApiWrapper uses
+(see its parsed_roots argument) to skip parsing and extracting entries from
+XML it has already handled; only the entry objects are rebuilt.
+
+  $ python -m merriam_webster.sharedcache /tmp/mw-cache.sock 4096
+
+  >>> learners = LearnersDictionary(key, CacheClient('/tmp/mw-cache.sock'))
+
+The wire protocol is one request line per connection: "GET <url>" or
+"STATS". The reply is a "<status> <length> [<hash>]" line followed by
+length bytes of body, where status is OK or ERR and hash is the content hash
+of a GET response. STATS bodies are JSON.
+
+"""
+
+import errno
+import hashlib
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+# url prefixes a CacheServer will fetch by default.
+API_PREFIXES = ('http://www.dictionaryapi.com/api/',
+                'https://www.dictionaryapi.com/api/')
+
+
+class CachedResponse(object):
+    """ A response body with its validators, content hash and fetch time. """
+
+    def __init__(self, data, etag=None, last_modified=None, fetched=None):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = hashlib.sha1(data).hexdigest()
+        self.fetched = time.time() if fetched is None else fetched
+
+    @classmethod
+    def from_response(cls, response):
+        " Builds a CachedResponse from a file-like urlopen result. "
+        headers = getattr(response, 'headers', None) or {}
+        return cls(response.read(), headers.get('ETag'),
+                   headers.get('Last-Modified'))
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def open(self):
+        " Returns a file-like object of the body, as urlopen would. "
+        response = io.BytesIO(self.data)
+        response.content_hash = self.content_hash
+        return response
+
+
+class _Fetch(object):
+    " An upstream request that other threads missing on the same url wait on. "
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class ResponseCache(object):
+    """ Thread-safe LRU of url -> CachedResponse with request coalescing.
+
+    Only one upstream fetch runs per url at a time; concurrent misses for the
+    same url wait for it and share its result (or its error). Failed fetches
+    aren't cached.
+
+    If ttl (seconds) is set, older responses are revalidated with a
+    conditional GET. For grace seconds after expiry the stale response is
+    returned right away and revalidated in a background thread; after that
+    callers wait for revalidation. A ResponseCache can also be passed as the
+    urlopen argument of an MWApiWrapper to cache within a single process.
+    The responses it returns carry a content_hash, so a wrapper keeping
+    parsed_roots (16 by default) won't re-parse or re-extract a response
+    that revalidated unchanged, as long as its tree is still kept.
+
+    """
+
+    def __init__(self, capacity=1024, urlopen=urlopen, ttl=None, grace=0):
+        self.capacity = capacity
+        self.urlopen = urlopen
+        self.ttl = ttl
+        self.grace = grace
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0,
+                       'errors': 0, 'evictions': 0, 'stale': 0,
+                       'revalidations': 0, 'unchanged': 0}
+
+    def __call__(self, url):
+        return self.get(url).open()
+
+    def get(self, url):
+        " Returns the CachedResponse for url, fetching it if needed. "
+        background = None
+        with self._lock:
+            cached = self._entries.get(url)
+            if cached is not None:
+                self._entries.move_to_end(url)
+                age = cached.age()
+                if self.ttl is None or age < self.ttl:
+                    self._stats['hits'] += 1
+                    return cached
+                if age < self.ttl + self.grace:
+                    self._stats['stale'] += 1
+                    if url in self._inflight:
+                        return cached  # already being revalidated
+                    background = self._inflight[url] = _Fetch()
+            if background is None:
+                fetch = self._inflight.get(url)
+                leader = fetch is None
+                if leader:
+                    fetch = self._inflight[url] = _Fetch()
+                    self._stats['misses'] += 1
+                else:
+                    self._stats['coalesced'] += 1
+        if background is not None:
+            thread = threading.Thread(target=self._fetch,
+                                      args=(url, background, cached))
+            thread.daemon = True
+            thread.start()
+            return cached
+        if leader:
+            self._fetch(url, fetch, cached)
+        else:
+            fetch.done.wait()
+        if fetch.error is not None:
+            raise fetch.error
+        return fetch.response
+
+    def _fetch(self, url, fetch, cached=None):
+        try:
+            fetch.response = self._request(url, cached)
+        except Exception as e:
+            fetch.error = e
+        with self._lock:
+            del self._inflight[url]
+            if fetch.error is None:
+                if cached is not None:
+                    self._stats['revalidations'] += 1
+                    if fetch.response.content_hash == cached.content_hash:
+                        self._stats['unchanged'] += 1
+                self._entries[url] = fetch.response
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+            else:
+                self._stats['errors'] += 1
+        fetch.done.set()
+
+    def _request(self, url, cached=None):
+        """ Fetches url, conditionally if cached has validators. A 304 Not
+        Modified yields a fresh copy of cached.
+
+        """
+        if cached is None or not (cached.etag or cached.last_modified):
+            return CachedResponse.from_response(self.urlopen(url))
+        headers = {}
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        try:
+            response = self.urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            if e.code != 304:
+                raise
+            response = e
+        if getattr(response, 'code', None) == 304:
+            headers = getattr(response, 'headers', None) or {}
+            return CachedResponse(cached.data,
+                                  headers.get('ETag') or cached.etag,
+                                  headers.get('Last-Modified') or
+                                  cached.last_modified)
+        return CachedResponse.from_response(response)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['capacity'] = self.capacity
+        return stats
+
+
+class _CacheRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8').strip()
+        command, _, arg = line.partition(' ')
+        cache = self.server.cache
+        if command == 'GET' and arg and not self.server.allowed(arg):
+            message = "URL not allowed: {0!r}".format(arg)
+            self._reply('ERR', message.encode('utf-8'))
+        elif command == 'GET' and arg:
+            try:
+                cached = cache.get(arg)
+                self._reply('OK', cached.data, cached.content_hash)
+            except Exception as e:
+                self._reply('ERR', str(e).encode('utf-8'))
+        elif command == 'STATS':
+            self._reply('OK', json.dumps(cache.stats()).encode('utf-8'))
+        else:
+            message = "Bad request: {0!r}".format(line)
+            self._reply('ERR', message.encode('utf-8'))
+
+    def _reply(self, status, body, content_hash=None):
+        header = "{0} {1}".format(status, len(body))
+        if content_hash:
+            header = "{0} {1}".format(header, content_hash)
+        self.wfile.write(header.encode('utf-8') + b"\n" + body)
+
+
+class CacheServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """ Serves a ResponseCache over the Unix domain socket at path.
+
+    Only http and https urls starting with one of prefixes are fetched (any
+    http(s) url if prefixes is None); other GETs are answered with ERR. The
+    socket file is given mode, so which users may connect is explicit. A
+    socket left at path by a server that's no longer running is replaced;
+    anything else at path (a live server's socket, a regular file) raises
+    OSError.
+
+    Use serve_forever() to run it, or start() to run it in a daemon thread.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, capacity=1024, urlopen=urlopen, ttl=None,
+                 grace=0, prefixes=API_PREFIXES, mode=0o600):
+        self.path = path
+        self.cache = ResponseCache(capacity, urlopen, ttl, grace)
+        self.prefixes = None if prefixes is None else tuple(prefixes)
+        self.mode = mode
+        _remove_stale_socket(path)
+        socketserver.UnixStreamServer.__init__(self, path,
+                                               _CacheRequestHandler)
+
+    def server_bind(self):
+        # before listen(), so nobody can connect under the umask's mode
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.path, self.mode)
+
+    def allowed(self, url):
+        " Returns whether the server will fetch url. "
+        if urlparse(url).scheme not in ('http', 'https'):
+            return False
+        return self.prefixes is None or url.startswith(self.prefixes)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _remove_stale_socket(path):
+    " Unlinks the socket at path if no server is listening on it. "
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, "Not a socket", path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise OSError(errno.EADDRINUSE, "A server is already listening", path)
+
+
+class CacheClient(object):
+    """ A urlopen replacement that fetches through a CacheServer.
+
+    Upstream failures are raised as urllib.error.URLError.
+
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def __call__(self, url):
+        body, content_hash = self._request("GET {0}".format(url))
+        response = io.BytesIO(body)
+        response.content_hash = content_hash
+        return response
+
+    def stats(self):
+        " Returns the server's hit/miss/coalescing counters as a dict. "
+        return json.loads(self._request("STATS")[0].decode('utf-8'))
+
+    def _request(self, line):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall(line.encode('utf-8') + b"\n")
+            reply = sock.makefile('rb')
+            header = reply.readline().decode('utf-8').split()
+            status, length = header[0], int(header[1])
+            content_hash = header[2] if len(header) > 2 else None
+            body = reply.read(length)
+            reply.close()
+        finally:
+            sock.close()
+        if status != 'OK':
+            raise URLError(body.decode('utf-8'))
+        return body, content_hash
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m merriam_webster.sharedcache SOCKET [CAPACITY "
+              "[TTL [GRACE]]]")
+        sys.exit(1)
+    capacity = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    ttl = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    grace = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+    server = CacheServer(sys.argv[1], capacity, ttl=ttl, grace=grace)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
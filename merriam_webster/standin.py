@@ -0,0 +1,265 @@
+# -*- encoding: utf-8 -*-
+
+"""
+A local stand-in for the Merriam-Webster XML API, and a load-test driver.
+
+StandInServer answers /api/v1/references/<reference>/xml/<word>?key=... with
+recorded fixtures or, failing that, generated MW-shaped XML. Fixtures are
+data_dir/<reference>/<segment>.xml, where segment is the word quoted as in
+request urls (ice%20cream.xml), the layout tests.py records to. Latency,
+server errors, malformed XML and invalid API keys can be injected. Point a
+dictionary at it by overriding its base_url:
+
+  >>> server = StandInServer(latency=0.05, error_rate=0.01).start()
+  >>> learners = LearnersDictionary('KEY')
+  >>> learners.base_url = server.base_url('learners')
+
+load_test() runs lookups at a target concurrency and reports latency
+percentiles and throughput, both of all lookups and of successful ones;
+examples/loadtest.py wraps both from the command line.
+
+"""
+
+import math
+import os
+import random
+import re
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, quote, unquote, urlparse
+from xml.sax.saxutils import escape
+
+LEARNERS_ENTRY = u"""
+  <entry id="{word}[{num}]">
+    <hw>{word}</hw>
+    <pr>ˈ{word}</pr>
+    <sound><wav>{word}0{num}.wav</wav></sound>
+    <art><artref id="{word}{num}.tif"/></art>
+    <fl>{function}</fl>
+    <in><il>plural</il> <if>{word}s</if></in>
+    <def>{senses}</def>
+  </entry>"""
+
+COLLEGIATE_ENTRY = u"""
+  <entry id="{word}[{num}]">
+    <hw>{word}</hw>
+    <sound><wav>{word}000{num}.wav</wav></sound>
+    <pr>ˈ{word}</pr>
+    <fl>{function}</fl>
+    <in><if>{word}*er</if><il>or</il><if>{word}*ier</if></in>
+    <art><bmp>{word}.bmp</bmp></art>
+    <def>{senses}</def>
+  </entry>"""
+
+SENSE = u"""
+      <dt>:the {num} sense of <it>{word}</it> and its meaning
+        <vi>a {word} in a sentence [=an example]</vi></dt>"""
+
+FUNCTIONS = ['noun', 'verb', 'adjective', 'adverb']
+
+
+def generate_response(word, reference='learners', entries=2, senses=3):
+    """ Returns MW-shaped XML bytes with entries generated for word. The
+    learners reference gets the learners layout, any other the collegiate
+    one.
+
+    """
+    template = LEARNERS_ENTRY if reference == 'learners' else COLLEGIATE_ENTRY
+    word = escape(word, {'"': '&quot;'})
+    body = "".join(template.format(
+        word=word, num=num + 1, function=FUNCTIONS[num % len(FUNCTIONS)],
+        senses="".join(SENSE.format(word=word, num=n) for n in range(senses)))
+                   for num in range(entries))
+    xml = u'<?xml version="1.0" encoding="utf-8" ?>\n' \
+          u'<entry_list version="1.0">{0}\n</entry_list>'.format(body)
+    return xml.encode('utf-8')
+
+
+class _StandInRequestHandler(BaseHTTPRequestHandler):
+
+    path_pattern = re.compile(r'^/api/v1/references/([^/]+)/xml/(.+)$')
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        match = self.path_pattern.match(url.path)
+        if not match:
+            return self._reply(404, b"Not Found")
+        reference, word = match.group(1), unquote(match.group(2))
+        key = parse_qs(url.query).get('key', [None])[0]
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        if server.invalid_key or \
+           (server.keys is not None and key not in server.keys):
+            return self._reply(200, b"Invalid API key. Not subscribed for "
+                                    b"this reference.", 'text/html')
+        if random.random() < server.error_rate:
+            return self._reply(500, b"Internal Server Error")
+        data = server.response_for(reference, word)
+        if random.random() < server.malformed_rate:
+            data = data[:len(data) // 2]
+        self._reply(200, data)
+
+    def _reply(self, code, body, content_type='text/xml'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """ A local HTTP server serving MW-shaped XML responses.
+
+    latency (+ a uniform random jitter) is slept before every reply.
+    error_rate and malformed_rate are the fractions of requests answered with
+    a 500 or with truncated XML. If invalid_key is true, or keys is a
+    collection of keys and the request's key isn't in it, MW's invalid key
+    reply is sent instead. data_dir is searched for recorded fixtures.
+
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, data_dir=None, latency=0,
+                 jitter=0, error_rate=0, malformed_rate=0, invalid_key=False,
+                 keys=None):
+        self.data_dir = data_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.invalid_key = invalid_key
+        self.keys = keys
+        HTTPServer.__init__(self, (host, port), _StandInRequestHandler)
+
+    def base_url(self, reference):
+        " Returns the base_url to give dictionaries using reference. "
+        host, port = self.server_address[:2]
+        return "http://{0}:{1}/api/v1/references/{2}".format(host, port,
+                                                            reference)
+
+    def response_for(self, reference, word):
+        if self.data_dir:
+            data_dir = path.realpath(self.data_dir)
+            fn = path.realpath(path.join(data_dir, reference,
+                                         "{0}.xml".format(quote(word))))
+            # words like ../../x mustn't reach files outside data_dir
+            if fn.startswith(data_dir + os.sep) and path.exists(fn):
+                with open(fn, 'rb') as fh:
+                    return fh.read()
+        return generate_response(word, reference)
+
+    def start(self):
+        " Serves in a daemon thread and returns self. "
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def percentile(values, p):
+    " Returns the nearest-rank pth percentile of the sorted list values. "
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class LoadReport(object):
+    """ Results of a load_test run. Latencies are in seconds; those of
+    successful lookups and of failed ones are kept apart, so fast injected
+    errors don't skew the percentiles.
+
+    """
+
+    def __init__(self, latencies, error_latencies, errors, elapsed,
+                 concurrency):
+        self.latencies = sorted(latencies)
+        self.error_latencies = sorted(error_latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.concurrency = concurrency
+
+    @property
+    def requests(self):
+        return len(self.latencies) + len(self.error_latencies)
+
+    @property
+    def successes(self):
+        return len(self.latencies)
+
+    @property
+    def rps(self):
+        " Lookups per second, failed ones included. "
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def ok_rps(self):
+        " Successful lookups per second. "
+        return self.successes / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p):
+        return percentile(self.latencies, p)
+
+    def error_percentile(self, p):
+        return percentile(self.error_latencies, p)
+
+    def __str__(self):
+        lines = ["{0} lookups ({1} ok), concurrency {2}, {3:.2f}s: "
+                 "{4:.1f} req/s, {5:.1f} ok/s".format(
+                     self.requests, self.successes, self.concurrency,
+                     self.elapsed, self.rps, self.ok_rps)]
+        for label, latencies, pct in [
+                ("latency", self.latencies, self.percentile),
+                ("error latency", self.error_latencies,
+                 self.error_percentile)]:
+            if latencies:
+                lines.append("{0} p50 {1:.1f}ms  p95 {2:.1f}ms  "
+                             "p99 {3:.1f}ms".format(
+                                 label, *[pct(p) * 1000
+                                          for p in (50, 95, 99)]))
+        for name, count in sorted(self.errors.items()):
+            lines.append("{0}: {1}".format(name, count))
+        return "\n".join(lines)
+
+
+def load_test(dictionary, words, requests=1000, concurrency=8):
+    """ Looks up requests words (cycling through words) from dictionary with
+    concurrency threads and returns a LoadReport. Each lookup reads every
+    entry's senses, so parsing is included in the latency. Exceptions are
+    counted by class name.
+
+    """
+    errors = Counter()
+    lock = threading.Lock()
+
+    def run(word):
+        start = time.perf_counter()
+        try:
+            for entry in dictionary.lookup(word):
+                list(entry.senses)
+        except Exception as e:
+            with lock:
+                errors[e.__class__.__name__] += 1
+            return False, time.perf_counter() - start
+        return True, time.perf_counter() - start
+
+    words = [words[n % len(words)] for n in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(run, words))
+    elapsed = time.perf_counter() - start
+    return LoadReport([latency for ok, latency in results if ok],
+                      [latency for ok, latency in results if not ok],
+                      dict(errors), elapsed, concurrency)
@@ -1,15 +1,78 @@
 # -*- encoding: utf-8 -*-
 
+import io
+import os
 import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 import urllib
+from contextlib import contextmanager
 from os import path, getenv
 
 from api import (LearnersDictionary, CollegiateDictionary, IntermediateDictionary,
-                 WordNotFoundException, InvalidAPIKeyException)
+                 WordNotFoundException, InvalidAPIKeyException,
+                 InvalidResponseException, InvalidQueryException,
+                 QueryCanonicalizer)
+from sharedcache import CacheServer, CacheClient, ResponseCache, API_PREFIXES
+from standin import StandInServer, load_test, percentile
+from index import DefinitionIndex
+from profiling import AllocationProfiler, AllocationRegressionError
 
 TEST_DIR = path.dirname(__file__)
 
+# A small learners-shaped response, used by tests that must run offline.
+LEARNERS_XML = u"""<?xml version="1.0" encoding="utf-8" ?>
+<entry_list version="1.0">
+  <entry id="pirate[1]">
+    <hw>pi*rate</hw>
+    <pr>ˈpaɪrət</pr>
+    <sound><wav>pirate01.wav</wav></sound>
+    <fl>noun</fl>
+    <in><il>plural</il> <if>pi*rates</if></in>
+    <def>
+      <dt>:someone who attacks and steals from a ship at sea
+        <vi>a band of <it>pirates</it></vi></dt>
+      <dt>:someone who illegally copies the work of others</dt>
+    </def>
+  </entry>
+  <entry id="pirate[2]">
+    <hw>pirate</hw>
+    <art><artref id="pirate.tif"/></art>
+    <fl>verb</fl>
+    <def><dt>:to illegally copy</dt></def>
+  </entry>
+</entry_list>
+""".encode('utf-8')
+
+
+def fixture_opener(data, requests=None):
+    """ Returns a urlopen replacement that always serves data. Requested urls
+    are appended to requests if given.
+
+    """
+    def opener(url):
+        if requests is not None:
+            requests.append(url)
+        return io.BytesIO(data)
+    return opener
+
+
+def wait_for(condition, timeout=5):
+    """ Polls condition until it returns true. Returns False if that didn't
+    happen within timeout seconds.
+
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
 class MerriamWebsterTestCase(unittest.TestCase):
 
     @classmethod
@@ -122,6 +185,633 @@ class LearnersTests(MerriamWebsterTestCase):
             list(self.dictionary.lookup("3rd"))
 
 
+class EntryProjectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dictionary = LearnersDictionary('KEY',
+                                             fixture_opener(LEARNERS_XML))
+        self.lazy_dictionary = LearnersDictionary(
+            'KEY', fixture_opener(LEARNERS_XML), lazy_entries=True)
+
+    def test_fields(self):
+        entries = list(self.dictionary.lookup("pirate",
+                                              fields=['pronunciations']))
+        self.assertEqual(2, len(entries))
+        self.assertEqual("pirate", entries[0].word)
+        self.assertEqual([u"ˈpaɪrət"], entries[0].pronunciations)
+        self.assertEqual(None, entries[0].headword)
+        self.assertEqual(None, entries[0].senses)
+        self.assertEqual(None, entries[1].illustrations)
+        with self.assertRaises(ValueError):
+            self.dictionary.lookup("pirate", fields=['bogus'])
+
+    def test_lazy_entries(self):
+        entries = list(self.lazy_dictionary.lookup("pirate"))
+        first, second = entries
+        self.assertNotIn('pronunciations', first.__dict__)
+        self.assertEqual([u"ˈpaɪrət"], first.pronunciations)
+        self.assertIs(first.pronunciations, first.pronunciations)
+        self.assertNotIn('senses', first.__dict__)
+        self.assertEqual("noun", first.function)
+        self.assertEqual(
+            "http://media.merriam-webster.com/soundc11/p/pirate01.wav",
+            first.audio[0])
+        senses = list(first.senses)
+        self.assertEqual(2, len(senses))
+        self.assertEqual(['a band of pirates'], senses[0].examples)
+        self.assertEqual("www.learnersdictionary.com/art/ld/pirate.gif",
+                         second.illustrations[0])
+
+    def test_lazy_matches_eager(self):
+        eager = list(self.dictionary.lookup("pirate"))
+        lazy = list(self.lazy_dictionary.lookup("pirate"))
+        for e, l in zip(eager, lazy):
+            for name in ['word', 'headword', 'function', 'pronunciations',
+                         'audio', 'illustrations', 'alternate_headwords']:
+                self.assertEqual(getattr(e, name), getattr(l, name))
+            self.assertEqual([tuple(s) for s in e.senses],
+                             [tuple(s) for s in l.senses])
+
+    def test_lazy_fields(self):
+        entry = next(self.lazy_dictionary.lookup("pirate",
+                                                 fields=['headword']))
+        self.assertEqual("pi*rate", entry.headword)
+        self.assertEqual(None, entry.pronunciations)
+
+    def test_parse_xml_without_fields(self):
+        class IdsDictionary(LearnersDictionary):
+            def parse_xml(self, root, word):
+                return [e.get('id') for e in root.findall('entry')]
+        dictionary = IdsDictionary('KEY', fixture_opener(LEARNERS_XML))
+        self.assertEqual(['pirate[1]', 'pirate[2]'],
+                         dictionary.lookup("pirate"))
+
+
+class SharedCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.release = threading.Event()
+        opener = fixture_opener(LEARNERS_XML, self.requests)
+
+        def slow_opener(url):
+            if url.endswith('fail'):
+                raise IOError("upstream down")
+            self.release.wait(5)
+            return opener(url)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = CacheServer(path.join(self.tmpdir, 'cache.sock'),
+                                  capacity=2, urlopen=slow_opener)
+        self.server.start()
+        self.client = CacheClient(self.server.path, timeout=5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup_through_cache(self):
+        self.release.set()
+        dictionary = LearnersDictionary('KEY', self.client)
+        for _ in range(3):
+            entries = list(dictionary.lookup("pirate"))
+            self.assertEqual("pi*rate", entries[0].headword)
+        self.assertEqual(1, len(self.requests))
+        stats = self.client.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['size'])
+
+    def test_coalescing(self):
+        results = []
+        url = API_PREFIXES[0] + "url"
+        threads = [threading.Thread(
+            target=lambda: results.append(self.client(url).read()))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        coalesced = wait_for(lambda: self.client.stats()['coalesced'] >= 3)
+        self.release.set()
+        self.assertTrue(coalesced, "requests weren't coalesced")
+        for t in threads:
+            t.join()
+        self.assertEqual([LEARNERS_XML] * 4, results)
+        self.assertEqual(1, len(self.requests))
+
+    def test_eviction_and_errors(self):
+        self.release.set()
+        for url in ["a", "b", "c", "a"]:
+            self.client(API_PREFIXES[0] + url)
+        self.assertEqual(4, len(self.requests))
+        with self.assertRaises(urllib.error.URLError):
+            self.client(API_PREFIXES[0] + "fail")
+        stats = self.client.stats()
+        self.assertEqual(2, stats['evictions'])
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(2, stats['size'])
+
+    def test_disallowed_urls(self):
+        self.release.set()
+        for url in ["file:///etc/hostname", "ftp://www.dictionaryapi.com/",
+                    "http://example.com/api/"]:
+            with self.assertRaisesRegex(urllib.error.URLError, "not allowed"):
+                self.client(url)
+        self.assertEqual([], self.requests)
+        self.assertEqual(0o600, os.stat(self.server.path).st_mode & 0o777)
+
+    def test_socket_path(self):
+        self.release.set()
+        with self.assertRaises(OSError):
+            CacheServer(self.server.path)  # already being served
+        self.client(API_PREFIXES[0] + "url")
+        regular = path.join(self.tmpdir, 'notes.txt')
+        with open(regular, 'w') as fh:
+            fh.write("keep me")
+        with self.assertRaises(OSError):
+            CacheServer(regular)
+        self.assertTrue(path.isfile(regular))
+        stale = path.join(self.tmpdir, 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(stale)
+        sock.close()
+        server = CacheServer(stale)
+        server.server_close()
+
+
+class RevalidationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.parses = 0
+
+        def opener(request):
+            """ Serves LEARNERS_XML with an ETag, answering conditional
+            requests with 304 Not Modified. """
+            self.requests.append(request)
+            headers = {'ETag': '"v1"'}
+            if getattr(request, 'get_header', None) and \
+               request.get_header('If-none-match') == '"v1"':
+                raise urllib.error.HTTPError(request.full_url, 304,
+                                             "Not Modified", headers, None)
+            response = io.BytesIO(LEARNERS_XML)
+            response.headers = headers
+            return response
+        self.opener = opener
+
+    def _dictionary(self, cache):
+        dictionary = LearnersDictionary('KEY', cache, parsed_roots=8)
+        parse = dictionary._parse_response
+
+        def counting_parse(*args):
+            self.parses += 1
+            return parse(*args)
+        dictionary._parse_response = counting_parse
+        return dictionary
+
+    def test_stale_while_revalidate(self):
+        cache = ResponseCache(urlopen=self.opener, ttl=0, grace=60)
+        dictionary = self._dictionary(cache)
+        for i in range(3):
+            entries = list(dictionary.lookup("pirate"))
+            self.assertEqual("pi*rate", entries[0].headword)
+            self.assertTrue(
+                wait_for(lambda: cache.stats()['revalidations'] >= i),
+                "stale response wasn't revalidated")
+        stats = cache.stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(2, stats['stale'])
+        self.assertEqual(2, stats['unchanged'])
+        self.assertEqual('"v1"', self.requests[1].get_header('If-none-match'))
+        self.assertEqual(1, self.parses)
+
+    def test_synchronous_revalidation(self):
+        cache = ResponseCache(urlopen=self.opener, ttl=0, grace=0)
+        dictionary = self._dictionary(cache)
+        list(dictionary.lookup("pirate"))
+        list(dictionary.lookup("pirate"))
+        stats = cache.stats()
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['revalidations'])
+        self.assertEqual(1, stats['unchanged'])
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual(1, self.parses)
+
+    def test_fresh_hits(self):
+        cache = ResponseCache(urlopen=self.opener, ttl=60)
+        dictionary = self._dictionary(cache)
+        list(dictionary.lookup("pirate"))
+        list(dictionary.lookup("pirate"))
+        self.assertEqual(1, cache.stats()['hits'])
+        self.assertEqual(1, len(self.requests))
+
+    def test_extracted_values_reused(self):
+        cache = ResponseCache(urlopen=self.opener, ttl=0, grace=0)
+        dictionary = LearnersDictionary('KEY', cache)  # default parsed_roots
+        extractions = []
+        get_senses = dictionary._get_senses
+
+        def counting_get_senses(root):
+            extractions.append(root.get('id'))
+            return get_senses(root)
+        dictionary._get_senses = counting_get_senses
+        for _ in range(3):
+            first, second = dictionary.lookup("pirate")
+            senses = first.senses
+            self.assertEqual(2, len(list(senses)))
+            self.assertEqual([], list(senses))  # still an iterator
+            self.assertEqual(['plural'],
+                             [i.label for i in first.inflections])
+            self.assertEqual(1, len(list(second.senses)))
+            first.pronunciations.append("mutated")
+        self.assertEqual(['pirate[1]', 'pirate[2]'], extractions)
+        self.assertEqual(2, cache.stats()['unchanged'])
+        self.assertEqual([u"ˈpaɪrət"], first.pronunciations[:-1])
+        self.assertEqual(
+            [u"ˈpaɪrət"], next(dictionary.lookup("pirate")).pronunciations)
+
+
+class StandInTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _dictionary(self, dict_class, reference, key='KEY', **kwargs):
+        self.server = StandInServer(**kwargs).start()
+        dictionary = dict_class(key)
+        dictionary.base_url = self.server.base_url(reference)
+        return dictionary
+
+    def test_generated_responses(self):
+        learners = self._dictionary(LearnersDictionary, 'learners')
+        entries = list(learners.lookup("pirate"))
+        self.assertEqual(2, len(entries))
+        self.assertEqual("pirate", entries[0].word)
+        self.assertEqual("noun", entries[0].function)
+        self.assertEqual(3, len(list(entries[0].senses)))
+        self.server.shutdown()
+        self.server.server_close()
+        collegiate = self._dictionary(CollegiateDictionary, 'collegiate')
+        entry = next(collegiate.lookup("spry"))
+        self.assertEqual(['spry*er', 'spry*ier'],
+                         next(entry.inflections).forms)
+        self.assertEqual('http://www.merriam-webster.com/art/dict/spry.htm',
+                         entry.illustrations[0])
+        entry = next(collegiate.lookup('a<b & "c"'))
+        self.assertEqual('a<b & "c"', entry.headword)
+
+    def test_fixtures(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        data_dir = path.join(tmpdir, 'data')
+        os.makedirs(path.join(data_dir, 'learners'))
+        for fn in [path.join(data_dir, 'learners', 'pirate.xml'),
+                   path.join(data_dir, 'learners', 'ice%20cream.xml'),
+                   path.join(tmpdir, 'secret.xml')]:
+            with open(fn, 'wb') as fh:
+                fh.write(LEARNERS_XML)
+        learners = self._dictionary(LearnersDictionary, 'learners',
+                                    data_dir=data_dir)
+        self.assertEqual("pi*rate", next(learners.lookup("pirate")).headword)
+        self.assertEqual("pi*rate",
+                         next(learners.lookup("ice cream")).headword)
+        # paths outside data_dir get generated responses, not the file
+        self.assertEqual("../../secret",
+                         next(learners.lookup("../../secret")).headword)
+
+    def test_fault_injection(self):
+        learners = self._dictionary(LearnersDictionary, 'learners',
+                                    keys=['KEY'], malformed_rate=1)
+        with self.assertRaises(InvalidResponseException):
+            list(learners.lookup("pirate"))
+        learners.key = 'WRONG'
+        with self.assertRaises(InvalidAPIKeyException):
+            list(learners.lookup("pirate"))
+        self.server.malformed_rate = 0
+        self.server.error_rate = 1
+        learners.key = 'KEY'
+        with self.assertRaises(urllib.error.HTTPError):
+            list(learners.lookup("pirate"))
+
+    def test_load_test(self):
+        learners = self._dictionary(LearnersDictionary, 'learners',
+                                    error_rate=0.5)
+        report = load_test(learners, ['pirate', 'spry'], requests=40,
+                           concurrency=4)
+        self.assertEqual(40, report.requests)
+        errors = report.errors.get('HTTPError', 0)
+        self.assertTrue(0 < errors < 40)
+        self.assertEqual(40 - errors, report.successes)
+        self.assertEqual(errors, len(report.error_latencies))
+        self.assertTrue(report.percentile(50) <= report.percentile(99))
+        self.assertTrue(report.error_percentile(50) is not None)
+        self.assertAlmostEqual(40 / report.elapsed, report.rps)
+        self.assertTrue(0 < report.ok_rps < report.rps)
+        self.assertIn("error latency", str(report))
+        self.assertEqual(2, percentile([1, 2, 3, 4], 50))
+        self.assertEqual(4, percentile([1, 2, 3, 4], 99))
+
+
+class DefinitionIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = DefinitionIndex()
+        self.dictionary = LearnersDictionary(
+            'KEY', fixture_opener(LEARNERS_XML), index=self.index)
+
+    def test_search(self):
+        entries = list(self.dictionary.lookup("pirate"))
+        self.assertEqual(3, len(self.index))
+        self.assertEqual(2, len(list(entries[0].senses)))
+        hits = self.index.search("copy")
+        self.assertEqual(1, len(hits))
+        self.assertEqual(('pirate', 'verb'), (hits[0].word, hits[0].function))
+        hits = self.index.search("illegally")
+        self.assertEqual(2, len(hits))
+        self.assertEqual('verb', hits[0].function)  # shorter definition
+        self.assertEqual(1, len(self.index.search("band pirates")))  # example
+        self.assertEqual(2, len(self.index.search("noun")))
+        self.assertEqual([], self.index.search("band copy"))
+
+    def test_homographs(self):
+        dictionary = LearnersDictionary('KEY', fixture_opener(u"""
+            <entry_list version="1.0">
+              <entry id="bank[1]"><hw>bank</hw><fl>noun</fl>
+                <def><dt>:the land along the side of a river</dt></def>
+              </entry>
+              <entry id="bank[2]"><hw>bank</hw><fl>noun</fl>
+                <def><dt>:a business that keeps money</dt></def>
+              </entry>
+            </entry_list>""".encode('utf-8')), index=self.index)
+        list(dictionary.lookup("bank"))
+        list(dictionary.lookup("bank"))
+        self.assertEqual(2, len(self.index))
+        self.assertEqual(1, len(self.index.search("river")))
+        self.assertEqual(1, len(self.index.search("money")))
+        self.index.remove("bank[1]")
+        self.assertEqual([], self.index.search("river"))
+        self.assertEqual(1, len(self.index.search("money")))
+
+    def test_other_spellings(self):
+        dictionary = CollegiateDictionary('KEY', fixture_opener(LEARNERS_XML),
+                                          index=self.index)
+        for word in ["pirate", "pirates", "Pirate"]:
+            list(dictionary.lookup(word))
+        self.assertEqual(3, len(self.index))
+        self.assertEqual(1, len(self.index.search("steals")))
+        dictionary = CollegiateDictionary('KEY', fixture_opener(u"""
+            <entry_list version="1.0">
+              <entry><hw>spry</hw><def><dt>:nimble</dt></def></entry>
+              <entry><hw>spry</hw><def><dt>:lively</dt></def></entry>
+            </entry_list>""".encode('utf-8')), index=self.index)
+        list(dictionary.lookup("spry"))
+        list(dictionary.lookup("spry"))
+        self.assertEqual(5, len(self.index))
+        self.index.remove("spry[2]")
+        self.assertEqual([], self.index.search("lively"))
+
+    def test_ranking(self):
+        dictionary = LearnersDictionary('KEY', fixture_opener(u"""
+            <entry_list version="1.0">
+              <entry id="skiff[1]"><hw>skiff</hw><fl>noun</fl>
+                <def><dt>:a boat <vi>rowing</vi> <vi>sailing</vi>
+                  <vi>fishing</vi></dt></def>
+              </entry>
+              <entry id="liner[1]"><hw>liner</hw><fl>noun</fl>
+                <def><dt>:a large and usually luxurious passenger boat that
+                  sails on a regular schedule between distant ports of call
+                </dt></def>
+              </entry>
+            </entry_list>""".encode('utf-8')), index=self.index)
+        list(dictionary.lookup("boats"))
+        hits = self.index.search("boat")
+        self.assertEqual(['skiff', 'liner'], [h.word for h in hits])
+
+    def test_concurrent_lookups(self):
+        def look_up():
+            for _ in range(20):
+                list(self.dictionary.lookup("pirate"))
+                self.index.search("illegally")
+        threads = [threading.Thread(target=look_up) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(3, len(self.index))
+        self.assertEqual(2, len(self.index.search("illegally")))
+        self.assertEqual(3, sum(1 for doc in self.index._docs if doc))
+
+    def test_phrases(self):
+        list(self.dictionary.lookup("pirate"))
+        hits = self.index.search('"from a ship" steals')
+        self.assertEqual(1, len(hits))
+        self.assertTrue(hits[0].definition.startswith('someone who attacks'))
+        self.assertEqual([], self.index.search('"ship from"'))
+        # phrases don't span the definition and its examples
+        self.assertEqual([], self.index.search('"at sea a band"'))
+
+    def test_incremental_updates(self):
+        list(self.dictionary.lookup("pirate"))
+        list(self.dictionary.lookup("pirate"))
+        self.assertEqual(3, len(self.index))
+        self.assertEqual(1, len(self.index.search("copy")))
+        self.index.remove("pirate[2]")
+        self.assertEqual(2, len(self.index))
+        self.assertEqual([], self.index.search("copy"))
+
+    def test_save_and_load(self):
+        list(self.dictionary.lookup("pirate"))
+        self.index.remove("pirate[1]")
+        list(self.dictionary.lookup("pirate", fields=['headword', 'function',
+                                                      'senses']))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = path.join(tmpdir, 'index.mwi')
+        self.index.save(filename)
+        loaded = DefinitionIndex.load(filename)
+        self.assertEqual(len(self.index), len(loaded))
+        for query in ['copy', 'illegally', '"from a ship"', 'noun']:
+            self.assertEqual(
+                [(h.word, h.definition, h.score)
+                 for h in self.index.search(query)],
+                [(h.word, h.definition, h.score)
+                 for h in loaded.search(query)])
+        loaded.remove("pirate[2]")
+        self.assertEqual([], loaded.search("copy"))
+
+
+class AllocationProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = AllocationProfiler()
+        self.addCleanup(self.profiler.stop)
+
+    def test_phases(self):
+        dictionary = LearnersDictionary(
+            'KEY', ResponseCache(urlopen=fixture_opener(LEARNERS_XML)),
+            index=DefinitionIndex(), profiler=self.profiler, parsed_roots=8)
+        for _ in range(3):
+            list(dictionary.lookup("pirate"))
+        report = self.profiler.report()
+        self.assertEqual(6, report.entries)
+        self.assertEqual(3, report.phases['fetch'].calls)
+        self.assertEqual(1, report.phases['parse'].calls)  # parsed root reused
+        self.assertEqual(6, report.phases['extract'].calls)
+        self.assertEqual(6, report.phases['index'].calls)
+        self.assertEqual(
+            6, report.entry_classes['LearnersDictionaryEntry'].calls)
+        self.assertTrue(report.phases['parse'].allocated > 0)
+        self.assertTrue(report.top_sites)
+        self.assertIn("bytes retained per entry", str(report))
+
+    def test_check(self):
+        dictionary = LearnersDictionary('KEY', fixture_opener(LEARNERS_XML),
+                                        profiler=self.profiler)
+        self.profiler.start()
+        retained = [list(dictionary.lookup("pirate")) for _ in range(5)]
+        report = self.profiler.report()
+        self.assertTrue(report.bytes_per_entry > 0)
+        report.check(report.bytes_per_entry)
+        with self.assertRaises(AllocationRegressionError):
+            report.check(report.bytes_per_entry - 1)
+        self.profiler.reset()
+        self.assertEqual(0, self.profiler.report().entries)
+
+    def test_generators_and_lazy_attributes(self):
+        dictionary = LearnersDictionary('KEY', fixture_opener(LEARNERS_XML),
+                                        profiler=self.profiler)
+        entry = next(dictionary.lookup("pirate"))
+        self.assertIsInstance(entry.senses, list)  # built inside extract
+        self.assertIsInstance(entry.inflections, list)
+        self.profiler.reset()
+        dictionary.lazy_entries = True
+        entry = next(dictionary.lookup("pirate"))
+        stats = self.profiler.report().entry_classes['LearnersDictionaryEntry']
+        self.assertEqual((1, 1), (stats.calls, stats.entries))
+        self.assertEqual(2, len(entry.senses))
+        entry.pronunciations
+        stats = self.profiler.report().entry_classes['LearnersDictionaryEntry']
+        self.assertEqual((3, 1), (stats.calls, stats.entries))
+        self.assertTrue(stats.allocated > 0)
+
+    def test_lazy_entries_with_index(self):
+        phases, extracted_in = [], []
+
+        class StackProfiler(AllocationProfiler):
+            @contextmanager
+            def phase(self, name, *args, **kwargs):
+                phases.append(name)
+                try:
+                    with AllocationProfiler.phase(self, name, *args,
+                                                  **kwargs):
+                        yield
+                finally:
+                    phases.pop()
+        profiler = StackProfiler()
+        self.addCleanup(profiler.stop)
+        dictionary = LearnersDictionary(
+            'KEY', fixture_opener(LEARNERS_XML), lazy_entries=True,
+            index=DefinitionIndex(), profiler=profiler)
+        for arg in ['senses', 'headword', 'functional_label']:
+            get = getattr(dictionary, '_get_' + arg)
+
+            def recording_get(root, get=get):
+                extracted_in.append(list(phases))
+                return get(root)
+            setattr(dictionary, '_get_' + arg, recording_get)
+        list(dictionary.lookup("pirate"))
+        self.assertEqual(6, len(extracted_in))
+        for stack in extracted_in:
+            self.assertEqual({'extract'}, set(stack))
+        report = profiler.report()
+        self.assertEqual((2, 2), (report.phases['extract'].calls,
+                                  report.phases['extract'].entries))
+        self.assertEqual(2, report.phases['index'].calls)
+        self.assertEqual(
+            2, report.entry_classes['LearnersDictionaryEntry'].calls)
+
+    def test_concurrent_phases(self):
+        entered, release = threading.Event(), threading.Event()
+
+        def hold():
+            with self.profiler.phase('fetch'):
+                entered.set()
+                release.wait(5)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.assertTrue(entered.wait(5))
+        try:
+            with self.assertRaises(RuntimeError):
+                with self.profiler.phase('parse'):
+                    pass
+        finally:
+            release.set()
+            thread.join()
+        with self.profiler.phase('parse'):
+            with self.profiler.phase('extract'):
+                pass
+        self.assertEqual(1, self.profiler.report().phases['parse'].calls)
+
+
+class QueryCanonicalizerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.canonicalizer = QueryCanonicalizer()
+        self.cache = ResponseCache(
+            urlopen=fixture_opener(LEARNERS_XML, self.requests))
+        self.dictionary = LearnersDictionary('KEY', self.cache,
+                                             canonicalizer=self.canonicalizer)
+
+    def test_canonicalize(self):
+        canonicalize = self.canonicalizer.canonicalize
+        for query in [u"pirate", u"Pirate", u" pirate ", u"pirate\u00a0",
+                      u"pi*rate", u"pirate[1]", u"PI*RATE [2]"]:
+            self.assertEqual(u"pirate", canonicalize(query))
+        for query in [u" Ice \t cream", u"ice \u200b cream", u"ice * cream",
+                      u"ice\u00ad  cream [1]", u"*ice cream*"]:
+            self.assertEqual(u"ice cream", canonicalize(query))
+        self.assertEqual(u"caf\u00e9", canonicalize(u"Cafe\u0301"))
+        self.assertEqual(u"strasse", canonicalize(u"STRA\u00dfE"))
+        self.assertEqual(u"pirate", canonicalize(u"pi\u00adrate\u200b"))
+        self.assertEqual(u"\u0915\u094d\u0937",
+                         canonicalize(u"\u0915\u094d\u200d\u0937"))
+        for query in [u"", u"   ", u"***", u"?!", u"pi\x00rate",
+                      u"pi\ud800rate", u"\u00ad"]:
+            with self.assertRaises(InvalidQueryException):
+                canonicalize(query)
+
+    def test_bounded_memory(self):
+        canonicalizer = QueryCanonicalizer(capacity=2)
+        for query in [u"a", u"A", u"b", u"c", u"d", u" A "]:
+            canonicalizer(query)
+        stats = canonicalizer.stats()
+        self.assertEqual(1, stats['deduplicated'])  # "a" was forgotten
+        self.assertEqual(2, stats['distinct'])
+        self.assertEqual(2, len(canonicalizer._seen))
+
+    def test_lookup(self):
+        for query in [u"Pirate", u" pirate ", u"pirate\u00a0", u"pirate[1]",
+                      u"Pirate"]:
+            entries = list(self.dictionary.lookup(query))
+            self.assertEqual("pi*rate", entries[0].headword)
+        with self.assertRaises(WordNotFoundException):
+            self.dictionary.lookup(u" * ")
+        self.assertEqual(1, len(self.requests))
+        self.assertTrue(self.requests[0].startswith(
+            self.dictionary.base_url + "/xml/pirate?"))
+        self.assertEqual({'queries': 6, 'canonicalized': 5, 'rejected': 1,
+                          'deduplicated': 3, 'distinct': 1},
+                         self.canonicalizer.stats())
+        self.assertEqual(4, self.cache.stats()['hits'])
+        self.canonicalizer.reset()
+        self.assertEqual(0, self.canonicalizer.stats()['queries'])
+
+
 class CollegiateTests(MerriamWebsterTestCase):
 
     dict_class = CollegiateDictionary